@@ -0,0 +1,424 @@
+"""Shared RAG engine: embedding, vector store, and LLM setup for the GxP apps."""
+
+import os
+import json
+import string
+import hashlib
+import pickle
+import functools
+import itertools
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+import faiss
+import numpy as np
+import onnxruntime as ort
+import streamlit as st
+from langchain_community.document_loaders import PyPDFLoader
+from langchain_core.embeddings import Embeddings
+from langchain_groq import ChatGroq
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+from sentence_transformers import CrossEncoder
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from transformers import AutoTokenizer
+
+INDEX_DIR = "index_db/"
+MANIFEST_PATH = os.path.join(INDEX_DIR, "manifest.json")
+FAISS_INDEX_PATH = os.path.join(INDEX_DIR, "sop.faiss")
+DOCSTORE_PATH = os.path.join(INDEX_DIR, "docstore.pkl")
+MODEL_ID = "sentence-transformers/all-MiniLM-L6-v2"
+RERANKER_ID = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_POOL = 40
+ONNX_DIR = "minilm-onnx-int8"
+ONNX_FP_DIR = "minilm-onnx"
+EMBED_DIM = 384
+
+def file_hash(filepath):
+    with open(filepath, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+@st.cache_data(ttl=5)
+def list_pdfs(path="knowledge/"):
+    """Memoized (filename, mtime) listing — one scandir per 5s, not per keystroke.
+
+    os.scandir fuses the listing and stat into a single pass; the returned
+    tuple doubles as the invalidation key for setup_engine.
+    """
+    if not os.path.exists(path):
+        return ()
+    return tuple(sorted((e.name, e.stat().st_mtime) for e in os.scandir(path)
+                        if e.name.lower().endswith('.pdf')))
+
+def load_pdf(path, pdf):
+    """Load one PDF; errors are returned (not raised) so workers stay off Streamlit.
+
+    Module-level (and errors stringified) so it pickles across process workers.
+    """
+    try:
+        return pdf, PyPDFLoader(os.path.join(path, pdf)).load(), None
+    except Exception as e:
+        return pdf, [], str(e)
+
+class ONNXMiniLMEmbeddings(Embeddings):
+    """MiniLM via ONNX Runtime: INT8-quantized on CPU (2-4x faster than FP32),
+    full-precision on the CUDA provider when a GPU is present."""
+
+    def __init__(self):
+        if "CUDAExecutionProvider" in ort.get_available_providers():
+            # INT8 dynamic quantization targets CPU VNNI; on GPU the
+            # full-precision export with large batches is the fast path
+            if not os.path.isdir(ONNX_FP_DIR):
+                ORTModelForFeatureExtraction.from_pretrained(
+                    MODEL_ID, export=True).save_pretrained(ONNX_FP_DIR)
+            self.model = ORTModelForFeatureExtraction.from_pretrained(
+                ONNX_FP_DIR, provider="CUDAExecutionProvider")
+            self.batch_size = 128
+        else:
+            if not os.path.isdir(ONNX_DIR):
+                model = ORTModelForFeatureExtraction.from_pretrained(MODEL_ID, export=True)
+                quantizer = ORTQuantizer.from_pretrained(model)
+                qconfig = AutoQuantizationConfig.avx512_vnni(is_static=False)
+                quantizer.quantize(save_dir=ONNX_DIR, quantization_config=qconfig)
+            self.model = ORTModelForFeatureExtraction.from_pretrained(ONNX_DIR)
+            self.batch_size = 64
+        self.tokenizer = AutoTokenizer.from_pretrained(MODEL_ID)
+        self._query_cache = functools.lru_cache(maxsize=1024)(
+            lambda text: tuple(self._encode([text])[0].tolist()))
+
+    def _encode(self, texts):
+        inputs = self.tokenizer(texts, padding=True, truncation=True,
+                                max_length=256, return_tensors="np")
+        hidden = np.asarray(self.model(**inputs).last_hidden_state)
+        # Mean-pool over non-padding tokens, then L2-normalize
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / mask.sum(axis=1).clip(min=1e-9)
+        return pooled / np.linalg.norm(pooled, axis=1, keepdims=True)
+
+    def embed_documents(self, texts, batch_size=None):
+        # Fixed-size batches amortize tokenizer/dispatch overhead and keep the
+        # GEMMs large without padding every text to the longest in the corpus.
+        batch_size = batch_size or self.batch_size
+        batches = [self._encode(texts[i:i + batch_size])
+                   for i in range(0, len(texts), batch_size)]
+        return np.concatenate(batches).tolist() if batches else []
+
+    def embed_query(self, text):
+        # LRU layer beneath the Streamlit retrieval cache: the same prompt
+        # searched with a different k or source filter skips the forward pass
+        return list(self._query_cache(text))
+
+class SOPVectorStore:
+    """FAISS HNSW similarity search over SOP pages (graph traversal, not a full scan).
+
+    Vectors are stored int8-scalar-quantized, cutting index RAM ~4x vs float32
+    at ~96% recall.
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+        if os.path.exists(FAISS_INDEX_PATH):
+            self.index = faiss.read_index(FAISS_INDEX_PATH)
+            with open(DOCSTORE_PATH, "rb") as f:
+                self.docs = pickle.load(f)
+        else:
+            self.index = faiss.IndexHNSWSQ(EMBED_DIM, faiss.ScalarQuantizer.QT_8bit, 16)
+            self.index.hnsw.efConstruction = 64
+            self.docs = []
+        # basename -> vector ids, so source-scoped searches skip the rest
+        self.by_source = {}
+        for i, d in enumerate(self.docs):
+            self.by_source.setdefault(d.metadata.get("basename"), []).append(i)
+        # Vector batches held back until the quantizer can train on all of them
+        self._pending = []
+
+    def add_documents(self, documents):
+        if not documents:
+            return  # scanned/image-only PDFs yield no text chunks
+        vecs = np.asarray(self.embeddings.embed_documents(
+            [d.page_content for d in documents]), dtype=np.float32)
+        if not self.index.is_trained:
+            # Defer until flush() so the scalar quantizer's per-dim ranges come
+            # from the whole ingest, not whichever single PDF indexes first
+            self._pending.append(vecs)
+        else:
+            self.index.add(vecs)
+        for d in documents:
+            self.by_source.setdefault(d.metadata.get("basename"), []).append(len(self.docs))
+            self.docs.append(d)
+
+    def reset(self):
+        """Drop every vector and document (a source PDF changed or was removed)."""
+        self.index = faiss.IndexHNSWSQ(EMBED_DIM, faiss.ScalarQuantizer.QT_8bit, 16)
+        self.index.hnsw.efConstruction = 64
+        self.docs = []
+        self.by_source = {}
+
+    def flush(self):
+        """Train the quantizer over every buffered batch, then add them."""
+        if self._pending:
+            vecs = np.concatenate(self._pending)
+            if not self.index.is_trained:
+                self.index.train(vecs)
+            self.index.add(vecs)
+            self._pending = []
+
+    def persist(self):
+        self.flush()
+        faiss.write_index(self.index, FAISS_INDEX_PATH)
+        with open(DOCSTORE_PATH, "wb") as f:
+            pickle.dump(self.docs, f)
+
+    def similarity_search_with_score(self, query, k=6, source_filter=None):
+        """Top-k (document, squared-L2 distance) pairs; lower distance is closer."""
+        self.flush()
+        if not self.docs:
+            return []
+        q_vec = np.asarray([self.embeddings.embed_query(query)], dtype=np.float32)
+        self.index.hnsw.efSearch = 64
+        if source_filter:
+            candidate_ids = [i for f in source_filter for i in self.by_source.get(f, [])]
+            if candidate_ids:
+                sel = faiss.IDSelectorBatch(np.asarray(candidate_ids, dtype=np.int64))
+                params = faiss.SearchParametersHNSW(sel=sel, efSearch=256)
+                dists, ids = self.index.search(q_vec, min(k, len(candidate_ids)), params=params)
+                return [(self.docs[i], float(d)) for i, d in zip(ids[0], dists[0]) if i != -1]
+        dists, ids = self.index.search(q_vec, min(k, len(self.docs)))
+        return [(self.docs[i], float(d)) for i, d in zip(ids[0], dists[0]) if i != -1]
+
+    def similarity_search(self, query, k=6, source_filter=None):
+        return [d for d, _ in self.similarity_search_with_score(query, k, source_filter)]
+
+@st.cache_resource
+def get_embedder():
+    """One MiniLM instance per worker; engine rebuilds reuse it instead of
+    loading another ~90MB model copy."""
+    return ONNXMiniLMEmbeddings()
+
+@st.cache_resource
+def setup_engine(knowledge_path="knowledge/", library_key=None):
+    """Build (or incrementally extend) the persistent SOP index.
+
+    `library_key` is the (filename, mtime) tuple of the knowledge dir so the
+    resource cache invalidates when the library changes, not on function identity.
+    """
+    if not os.path.exists(knowledge_path):
+        os.makedirs(knowledge_path)
+    if not os.path.exists(INDEX_DIR):
+        os.makedirs(INDEX_DIR)
+    if library_key is None:
+        library_key = list_pdfs(knowledge_path)
+    pdf_files = [name for name, _ in library_key]
+    if not pdf_files:
+        return None
+
+    # Manifest of filename -> SHA-256 so already-indexed PDFs are not re-embedded
+    manifest = {}
+    if os.path.exists(MANIFEST_PATH):
+        with open(MANIFEST_PATH) as f:
+            manifest = json.load(f)
+    hashes = {pdf: file_hash(os.path.join(knowledge_path, pdf)) for pdf in pdf_files}
+
+    vectorstore = SOPVectorStore(get_embedder())
+
+    # Appending can extend the index but never drop a changed or deleted PDF's
+    # old vectors, which would keep retired SOP text retrievable and citable.
+    # Rebuild from scratch whenever a manifested file changed or vanished —
+    # that only happens on library edits, so the rebuild cost is rare.
+    stale = (any(pdf in manifest and manifest[pdf] != hashes[pdf] for pdf in pdf_files)
+             or any(pdf not in hashes for pdf in manifest))
+    if stale:
+        vectorstore.reset()
+        manifest = {}
+
+    # Already-indexed PDFs skip the load + embed pass entirely
+    new_pdfs = [pdf for pdf in pdf_files if manifest.get(pdf) != hashes[pdf]]
+
+    if new_pdfs:
+        # pypdf parsing is CPU-bound pure Python, so processes sidestep the GIL
+        workers = min(os.cpu_count() or 1, len(new_pdfs))
+        # Sub-page chunks fit MiniLM's 256-token window (whole pages got
+        # truncated) and keep k=6 retrieval from ballooning the LLM prompt
+        splitter = RecursiveCharacterTextSplitter(
+            chunk_size=400, chunk_overlap=50, length_function=len)
+        indexed_any = False
+        with ProcessPoolExecutor(max_workers=workers) as ex:
+            # Keep at most `workers` parse jobs in flight: ex.map would submit
+            # everything up front and buffer each finished PDF while the parent
+            # is stuck in the slower embed/add loop, converging back to
+            # whole-library peak memory
+            queued = iter(new_pdfs)
+            pending = deque(ex.submit(load_pdf, knowledge_path, pdf)
+                            for pdf in itertools.islice(queued, workers))
+            while pending:
+                pdf, pages, error = pending.popleft().result()
+                nxt = next(queued, None)
+                if nxt is not None:
+                    pending.append(ex.submit(load_pdf, knowledge_path, nxt))
+                if error is not None:
+                    st.warning(f"Could not load {pdf}: {error}")
+                    continue
+                for page in pages:
+                    page.metadata["doc_hash"] = hashes[pdf]
+                    # Precomputed once here so citation building is a dict lookup
+                    page.metadata["basename"] = pdf
+                vectorstore.add_documents(splitter.split_documents(pages))
+                manifest[pdf] = hashes[pdf]
+                indexed_any = True
+        if indexed_any or stale:
+            vectorstore.persist()
+            with open(MANIFEST_PATH, "w") as f:
+                json.dump(manifest, f)
+    return vectorstore
+
+FAST_MODEL = "llama-3.1-8b-instant"
+SMART_MODEL = "llama-3.3-70b-versatile"
+# Squared L2 between unit vectors (0.7 ~ cosine 0.65); below this the top hit
+# is close enough that the answer is straightforward extraction
+CONFIDENT_DISTANCE = 0.7
+
+@st.cache_resource
+def get_llm(model_name=SMART_MODEL):
+    """One ChatGroq client per model so each HTTPS connection pool is reused."""
+    return ChatGroq(
+        model_name=model_name,
+        groq_api_key=st.secrets["GROQ_API_KEY"],
+        temperature=0,
+        max_retries=2
+    )
+
+def pick_model(best_distance):
+    """Route confident retrievals to the cheap 8B model; escalate the rest."""
+    if best_distance is not None and best_distance < CONFIDENT_DISTANCE:
+        return FAST_MODEL
+    return SMART_MODEL
+
+def normalize_prompt(prompt):
+    return " ".join(prompt.lower().split())
+
+def snippet(doc, n=1024):
+    """Cap one retrieved chunk's contribution to the LLM prompt at ~1 KB."""
+    text = doc.page_content
+    return text if len(text) <= n else text[:n] + " …"
+
+def manifest_hash():
+    if os.path.exists(MANIFEST_PATH):
+        with open(MANIFEST_PATH, "rb") as f:
+            return hashlib.blake2b(f.read()).hexdigest()
+    return ""
+
+def match_sources(prompt, filenames):
+    """Source filter for SOPs the prompt explicitly names, else None.
+
+    Scoping must only trigger on a real mention: a generic word matching one
+    filename would silently exclude the document holding the answer.
+    """
+    # Strip punctuation so "deviation?" still counts as the word "deviation"
+    tokens = [t.strip(string.punctuation) for t in prompt.lower().split()]
+    cleaned = " ".join(t for t in tokens if t)
+    matched = {f for f in filenames if os.path.splitext(f)[0].lower() in cleaned}
+    if not matched:
+        # Only identifier-like tokens (contain a digit, e.g. "sop-279") may
+        # scope the search; plain words never narrow it
+        doc_ids = {t for t in tokens if len(t) >= 4 and any(c.isdigit() for c in t)}
+        matched = {f for f in filenames if any(t in f.lower() for t in doc_ids)}
+    return tuple(sorted(matched)) or None
+
+@st.cache_resource
+def get_reranker():
+    return CrossEncoder(RERANKER_ID)
+
+@st.cache_data(show_spinner=False, max_entries=512)
+def run_search(_engine, prompt_norm, k, manifest, sources=None):
+    """Cached retrieval: ANN over-fetch, cross-encoder rerank, keep top k.
+
+    The wider RERANK_POOL candidate set costs one batched encoder forward but
+    sends the LLM higher-quality chunks than raw ANN order. Returns the top-k
+    documents plus the best ANN distance as a routing confidence signal.
+    """
+    scored = _engine.similarity_search_with_score(
+        prompt_norm, k=RERANK_POOL, source_filter=sources)
+    best_distance = min((dist for _, dist in scored), default=None)
+    results = [d for d, _ in scored]
+    if len(results) > k:
+        scores = get_reranker().predict(
+            [(prompt_norm, d.page_content) for d in results],
+            batch_size=32, show_progress_bar=False)
+        results = [results[i] for i in np.argsort(scores)[::-1][:k]]
+    return results, best_distance
+
+SOURCE_MARKERS = ("SOURCE_TYPE: CONTENT", "SOURCE_TYPE: METADATA")
+
+# Static instructions go in the system role so Groq's prefix caching can
+# reuse their KV across a session; only the user message changes per turn
+SYSTEM_INSTRUCTIONS = """\
+You are a GxP Compliance Assistant. Each question comes with two sources:
+1. SYSTEM METADATA (Filenames)
+2. DOCUMENT CONTENT (Text inside PDFs)
+
+RULES:
+- If asking about the library/files/sidebar/inventory, start with 'SOURCE_TYPE: METADATA'.
+- If asking about SOP procedures/content/details, start with 'SOURCE_TYPE: CONTENT'. Cite SOP and Page.
+"""
+
+# Parsed once at import; per-query assembly is a single format_map allocation
+USER_TEMPLATE = """\
+1. SYSTEM METADATA (Filenames): {sop_list_str}
+2. DOCUMENT CONTENT (Text inside PDFs): {context_text}
+
+Question: {prompt}
+"""
+
+def stream_response(llm, messages, detected):
+    """Yield answer chunks from Groq with the SOURCE_TYPE routing prefix stripped.
+
+    `detected` is a one-element list set to the routing marker once it appears,
+    so the caller can pick the source pill after the stream finishes.
+    """
+    buffer = ""
+    started = False
+    for chunk in llm.stream(messages):
+        piece = chunk.content
+        if not piece:
+            continue
+        if started:
+            yield piece
+            continue
+        # Hold back the first few tokens until the routing marker is consumed
+        buffer += piece
+        for marker in SOURCE_MARKERS:
+            if marker in buffer:
+                detected[0] = marker
+                buffer = buffer.replace(marker, "").lstrip()
+                break
+        if detected[0] is not None or len(buffer) > 64:
+            started = True
+            if buffer:
+                yield buffer
+    if not started and buffer:
+        yield buffer
+
+def finalize_response(text, detected):
+    """Strip markers that slipped past the stream holdback and classify.
+
+    If the model emitted anything ahead of the SOURCE_TYPE marker, the
+    64-char holdback in stream_response gives up and streams it through; this
+    post-stream pass keeps markers out of history/cache and sets `detected`
+    from wherever the marker actually appeared.
+    """
+    for marker in SOURCE_MARKERS:
+        if marker in text:
+            detected[0] = marker
+            text = text.replace(marker, "")
+    return text.strip()
+
+@st.cache_resource
+def answer_cache():
+    """Shared (prompt, context) -> parsed answer cache; hits skip the Groq call."""
+    return {}
+
+def cache_answer(prompt_norm, context_hash, value, max_entries=512):
+    cache = answer_cache()
+    if len(cache) >= max_entries:
+        cache.pop(next(iter(cache)))
+    cache[(prompt_norm, context_hash)] = value